@@ -1,7 +1,8 @@
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import services
 from models import init_db
 
@@ -26,10 +27,12 @@ class TaskCompleteRequest(BaseModel):
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
     await init_db()
+    await services.init_cache()
     print('Bot is ready / DB initialized')
     yield
+    await services.close_cache()
 
-app = FastAPI(title="Math & Informatics App", lifespan=lifespan)
+app = FastAPI(title="Math & Informatics App", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -70,9 +73,24 @@ async def get_user_by_tg(tg_id: int):
 
 # --- Problems / Solve ---
 
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match: список через запятую, допускаются W/-теги и *."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
 @app.get("/api/problems/")
-async def get_problems(subject: str = Query(None, description="Subject filter"), difficulty: str = Query(None, description="Difficulty filter")):
-    return await services.get_problems(subject, difficulty)
+async def get_problems(request: Request, subject: str = Query(None, description="Subject filter"), difficulty: str = Query(None, description="Difficulty filter")):
+    problems, etag = await services.get_problems_with_etag(subject, difficulty)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    # Клиент с актуальной копией получает 304 без тела
+    if _etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(problems, headers=headers)
 
 @app.post("/api/solve/")
 async def solve_problem(solution: SolutionRequest):
@@ -1,13 +1,35 @@
-from sqlalchemy import ForeignKey, String, BigInteger, Text, Integer, Enum, Boolean, DateTime, select
-from sqlalchemy.orm import Mapped, DeclarativeBase, mapped_column
+from sqlalchemy import ForeignKey, String, BigInteger, Text, Integer, Enum, Boolean, DateTime, Index, select, insert, event
+from sqlalchemy.orm import Mapped, DeclarativeBase, mapped_column, relationship
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 import enum
+import os
 from datetime import datetime
 
 DATABASE_URL = 'sqlite+aiosqlite:///db.sqlite3'
-engine = create_async_engine(url=DATABASE_URL, echo=True)
+# Логирование SQL включается только явно: SQL_ECHO=1
+SQL_ECHO = os.getenv('SQL_ECHO', '').lower() in ('1', 'true', 'yes')
+# Пул по умолчанию (AsyncAdaptedQueuePool) уже переиспользует соединения.
+# StaticPool не используем — одно соединение на все корутины смешивает их транзакции.
+engine = create_async_engine(url=DATABASE_URL, echo=SQL_ECHO, echo_pool=False)
 async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
 
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",
+    "foreign_keys=ON",
+    "mmap_size=268435456",
+)
+
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    """WAL + NORMAL: читатели не блокируют писателей, commit без fsync на каждую транзакцию."""
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
@@ -33,6 +55,9 @@ class User(Base):
 
 class Problem(Base):
     __tablename__ = 'problems'
+    __table_args__ = (
+        Index('ix_problems_subject_difficulty', 'subject', 'difficulty'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str] = mapped_column(String(128))
@@ -42,8 +67,15 @@ class Problem(Base):
     correct_answer: Mapped[str] = mapped_column(String(256))
     points: Mapped[int] = mapped_column(Integer, default=10)
 
+    # lazy="raise": неявная подгрузка запрещена, нужен явный selectinload()
+    solutions: Mapped[list['UserSolution']] = relationship(back_populates='problem', lazy='raise')
+
 class UserSolution(Base):
     __tablename__ = 'user_solutions'
+    __table_args__ = (
+        # покрывает фильтр статистики (user_id, is_correct) и join по problem_id
+        Index('ix_us_user_correct_problem', 'user_id', 'is_correct', 'problem_id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
@@ -52,6 +84,8 @@ class UserSolution(Base):
     is_correct: Mapped[bool] = mapped_column(Boolean, default=False)
     solved_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    problem: Mapped['Problem'] = relationship(back_populates='solutions', lazy='raise')
+
 
 async def init_db():
     """
@@ -65,42 +99,43 @@ async def init_db():
         existing = await session.scalar(select(Problem).limit(1))
         if not existing:
             math_problems = [
-                Problem(
-                    title="Квадратное уравнение",
-                    description="Решите уравнение: x² - 5x + 6 = 0",
-                    subject=Subject.MATH,
-                    difficulty=Difficulty.EASY,
-                    correct_answer="2;3",
-                    points=10
-                ),
-                Problem(
-                    title="Площадь треугольника",
-                    description="Найдите площадь треугольника со сторонами 5, 12, 13",
-                    subject=Subject.MATH,
-                    difficulty=Difficulty.MEDIUM,
-                    correct_answer="30",
-                    points=20
-                )
+                {
+                    'title': "Квадратное уравнение",
+                    'description': "Решите уравнение: x² - 5x + 6 = 0",
+                    'subject': Subject.MATH,
+                    'difficulty': Difficulty.EASY,
+                    'correct_answer': "2;3",
+                    'points': 10
+                },
+                {
+                    'title': "Площадь треугольника",
+                    'description': "Найдите площадь треугольника со сторонами 5, 12, 13",
+                    'subject': Subject.MATH,
+                    'difficulty': Difficulty.MEDIUM,
+                    'correct_answer': "30",
+                    'points': 20
+                }
             ]
 
             informatics_problems = [
-                Problem(
-                    title="Бинарный поиск",
-                    description="Какая сложность у бинарного поиска?",
-                    subject=Subject.INFORMATICS,
-                    difficulty=Difficulty.EASY,
-                    correct_answer="O(log n)",
-                    points=10
-                ),
-                Problem(
-                    title="Алгоритмы сортировки",
-                    description="Какой алгоритм сортировки имеет сложность O(n²) в худшем случае?",
-                    subject=Subject.INFORMATICS,
-                    difficulty=Difficulty.MEDIUM,
-                    correct_answer="пузырьковая сортировка",
-                    points=20
-                )
+                {
+                    'title': "Бинарный поиск",
+                    'description': "Какая сложность у бинарного поиска?",
+                    'subject': Subject.INFORMATICS,
+                    'difficulty': Difficulty.EASY,
+                    'correct_answer': "O(log n)",
+                    'points': 10
+                },
+                {
+                    'title': "Алгоритмы сортировки",
+                    'description': "Какой алгоритм сортировки имеет сложность O(n²) в худшем случае?",
+                    'subject': Subject.INFORMATICS,
+                    'difficulty': Difficulty.MEDIUM,
+                    'correct_answer': "пузырьковая сортировка",
+                    'points': 20
+                }
             ]
 
-            session.add_all(math_problems + informatics_problems)
+            # Core executemany вместо ORM add_all: без unit-of-work и identity map
+            await session.execute(insert(Problem), math_problems + informatics_problems)
             await session.commit()
@@ -1,31 +1,94 @@
-from sqlalchemy import select, update, delete, func, desc
+from sqlalchemy import select, insert, update, delete, func, desc
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from models import async_session, User, Problem, UserSolution, Subject, Difficulty
 from passlib.context import CryptContext
+from redis.exceptions import RedisError
+import redis.asyncio as aioredis
+import orjson
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import os
 import re
+import time
 
-pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_ctx = CryptContext(schemes=["bcrypt"], bcrypt__rounds=11, deprecated="auto")
 
-def _hash_password(password: str) -> str:
-    return pwd_ctx.hash(password)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+STATS_CACHE_TTL = 30
+redis_client: Optional[aioredis.Redis] = None
 
-def _verify_password(password: str, hashed: str) -> bool:
-    return pwd_ctx.verify(password, hashed)
+_WS_RE = re.compile(r'\s+')
+_SEP_RE = re.compile(r'[;,]')
+
+# bcrypt — CPU-bound, выполняем в пуле потоков, чтобы не блокировать event loop
+async def _hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(None, pwd_ctx.hash, password)
+
+async def _verify_password(password: str, hashed: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(None, pwd_ctx.verify, password, hashed)
 
 def _normalize_answer(s: str) -> str:
     if s is None:
         return ""
-    return re.sub(r'\s+', '', s.lower()).replace(',', '.').strip()
+    return _WS_RE.sub('', s.lower()).replace(',', '.')
 
 def _answer_to_set(s: str):
     """Если ответ содержит разделители (; ,), вернём множество вариантов."""
     if s is None:
         return set()
-    parts = re.split(r'[;,]', s)
+    parts = _SEP_RE.split(s)
     return set(_normalize_answer(p) for p in parts if p != '')
 
+# ---------------- Cache ----------------
+
+async def init_cache():
+    """Создаёт клиент Redis с пулом соединений (вызывается из lifespan)."""
+    global redis_client
+    redis_client = aioredis.from_url(
+        REDIS_URL,
+        max_connections=20,
+        socket_connect_timeout=0.2,
+        socket_timeout=0.2,
+    )
+
+async def close_cache():
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+
+def _stats_key(user_id: int) -> str:
+    return f'stats:{user_id}'
+
+# При недоступном Redis кэш просто пропускается — данные берутся из БД
+async def _cache_get(key: str):
+    if redis_client is None:
+        return None
+    try:
+        value = await redis_client.get(key)
+    except RedisError:
+        return None
+    return orjson.loads(value) if value else None
+
+async def _cache_set(key: str, value, ttl: int):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.setex(key, ttl, orjson.dumps(value))
+    except RedisError:
+        pass
+
+async def _cache_delete(key: str):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(key)
+    except RedisError:
+        pass
+
 # ---------------- User management ----------------
 
 async def get_user_by_tg(tg_id: int) -> Optional[User]:
@@ -44,23 +107,28 @@ async def add_user(tg_id: int = None, name: str = None, email: str = None, passw
     """
     async with async_session() as session:
         if tg_id:
-            user = await session.scalar(select(User).where(User.tg_id == tg_id))
-            if user:
-                return user
-            new_user = User(tg_id=tg_id, name=name)
-            session.add(new_user)
+            # UPSERT: один запрос и для нового, и для существующего пользователя
+            stmt = (
+                sqlite_insert(User)
+                .values(tg_id=tg_id, name=name)
+                .on_conflict_do_update(index_elements=[User.tg_id], set_={'tg_id': tg_id})
+                .returning(User)
+            )
+            user = (await session.execute(stmt)).scalar_one()
             await session.commit()
-            await session.refresh(new_user)
-            return new_user
+            return user
 
         if email:
             user = await session.scalar(select(User).where(User.email == email))
             if user:
                 return None  # уже есть
-            new_user = User(email=email, name=name, password_hash=_hash_password(password))
-            session.add(new_user)
+            password_hash = await _hash_password(password)
+            new_user = (await session.execute(
+                insert(User)
+                .values(email=email, name=name, password_hash=password_hash)
+                .returning(User)
+            )).scalar_one()
             await session.commit()
-            await session.refresh(new_user)
             return new_user
 
 async def register_user_via_email(email: str, password: str, name: str = None):
@@ -75,26 +143,71 @@ async def check_credentials(email: str, password: str):
         return None
     if not user.password_hash:
         return None
-    if _verify_password(password, user.password_hash):
+    if await _verify_password(password, user.password_hash):
         return user
     return None
 
 # ---------------- Problems & Solutions ----------------
 
+# Кэш списка задач: ключ (subject, difficulty) -> (время записи, список словарей, ETag)
+_PROBLEMS_TTL = 30.0
+_problems_cache: dict[tuple, tuple[float, list, str]] = {}
+# Ответ и баллы задачи по id: problem_id -> (время записи, correct_answer, points).
+# Изменения задачи в БД видны в check_solution не позже чем через _PROBLEMS_TTL секунд.
+_problem_by_id: dict[int, tuple[float, str, int]] = {}
+
+def invalidate_problems_cache():
+    """Сбрасывает кэш задач; вызывать после добавления/изменения задач."""
+    _problems_cache.clear()
+    _problem_by_id.clear()
+
+async def _get_problem(session, problem_id: int) -> Optional[tuple[str, int]]:
+    """Возвращает (correct_answer, points) или None, если задачи нет."""
+    cached = _problem_by_id.get(problem_id)
+    if cached and time.monotonic() - cached[0] < _PROBLEMS_TTL:
+        return cached[1], cached[2]
+    row = (await session.execute(
+        select(Problem.correct_answer, Problem.points).where(Problem.id == problem_id)
+    )).first()
+    if row is None:
+        _problem_by_id.pop(problem_id, None)
+        return None
+    _problem_by_id[problem_id] = (time.monotonic(), row.correct_answer, row.points)
+    return row.correct_answer, row.points
+
+def _parse_enum(enum_cls, value):
+    """Невалидное значение фильтра трактуем как его отсутствие."""
+    if not value:
+        return None
+    try:
+        return enum_cls(value)
+    except ValueError:
+        return None
+
 async def get_problems(subject: str = None, difficulty: str = None):
+    problems, _ = await get_problems_with_etag(subject, difficulty)
+    return problems
+
+async def get_problems_with_etag(subject: str = None, difficulty: str = None):
+    """Возвращает (список задач, ETag); ETag — хэш содержимого и меняется вместе с данными."""
+    # Ключ строится из распознанных фильтров, поэтому записей не больше 3 * 4
+    key = (_parse_enum(Subject, subject), _parse_enum(Difficulty, difficulty))
+    cached = _problems_cache.get(key)
+    if cached and time.monotonic() - cached[0] < _PROBLEMS_TTL:
+        return cached[1], cached[2]
+    result = await _load_problems(*key)
+    etag = '"' + hashlib.blake2b(orjson.dumps(result), digest_size=16).hexdigest() + '"'
+    _problems_cache[key] = (time.monotonic(), result, etag)
+    return result, etag
+
+async def _load_problems(subject: Optional[Subject], difficulty: Optional[Difficulty]):
     async with async_session() as session:
         query = select(Problem)
-        if subject:
-            try:
-                query = query.where(Problem.subject == Subject(subject))
-            except Exception:
-                pass
-        if difficulty:
-            try:
-                query = query.where(Problem.difficulty == Difficulty(difficulty))
-            except Exception:
-                pass
-        problems = await session.scalars(query)
+        if subject is not None:
+            query = query.where(Problem.subject == subject)
+        if difficulty is not None:
+            query = query.where(Problem.difficulty == difficulty)
+        problems = await session.stream_scalars(query.execution_options(yield_per=200))
         return [
             {
                 'id': p.id,
@@ -103,7 +216,7 @@ async def get_problems(subject: str = None, difficulty: str = None):
                 'subject': p.subject.value,
                 'difficulty': p.difficulty.value,
                 'points': p.points
-            } for p in problems
+            } async for p in problems
         ]
 
 # В файл services.py добавляем новую функцию и обновляем check_solution
@@ -133,43 +246,54 @@ async def check_solution(user_id: int, problem_id: int, user_answer: str):
                 'new_score': 0
             }
 
-        problem = await session.scalar(select(Problem).where(Problem.id == problem_id))
-        user = await session.scalar(select(User).where(User.id == user_id))
-        if not problem or not user:
+        problem = await _get_problem(session, problem_id)
+        if not problem:
             return {'error': 'user or problem not found'}
+        correct_answer, points = problem
 
         # сравнение ответов (поддерживает варианты вида "2;3")
-        correct_raw = problem.correct_answer or ""
+        correct_raw = correct_answer or ""
         # если в ответе есть разделители — сравним множества
-        if re.search(r'[;,]', correct_raw):
+        if _SEP_RE.search(correct_raw):
             is_correct = _answer_to_set(user_answer) == _answer_to_set(correct_raw)
         else:
             is_correct = _normalize_answer(user_answer) == _normalize_answer(correct_raw)
 
+        if is_correct:
+            # Атомарно начисляем очки; уровень повышается каждые 100 очков
+            new_score_expr = func.coalesce(User.score, 0) + (points or 0)
+            new_score = await session.scalar(
+                update(User)
+                .where(User.id == user_id)
+                .values(score=new_score_expr, level=new_score_expr // 100 + 1)
+                .returning(User.score)
+            )
+        else:
+            new_score = await session.scalar(
+                select(func.coalesce(User.score, 0)).where(User.id == user_id)
+            )
+        if new_score is None:
+            return {'error': 'user or problem not found'}
+
         # Сохраняем решение
-        solution = UserSolution(
+        session.add(UserSolution(
             user_id=user_id,
             problem_id=problem_id,
             user_answer=user_answer,
             is_correct=is_correct
-        )
-
-        if is_correct:
-            user.score = (user.score or 0) + (problem.points or 0)
-            # Повышаем уровень каждые 100 очков
-            user.level = (user.score // 100) + 1
-
-        session.add(solution)
+        ))
         await session.commit()
-        await session.refresh(user)
+        if is_correct:
+            await _cache_delete(_stats_key(user_id))
 
         return {
             'correct': is_correct,
             'already_solved': False,
-            'correct_answer': None if is_correct else problem.correct_answer,
-            'points_earned': problem.points if is_correct else 0,
-            'new_score': user.score
+            'correct_answer': None if is_correct else correct_answer,
+            'points_earned': points if is_correct else 0,
+            'new_score': new_score
         }
+
 async def get_weekly_stats(user_id: int):
     """Получает статистику решённых задач за последние 7 дней"""
     async with async_session() as session:
@@ -190,30 +314,31 @@ async def get_weekly_stats(user_id: int):
 # ---------------- Stats ----------------
 
 async def get_user_stats(user_id: int):
+    key = _stats_key(user_id)
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
+    stats = await _compute_user_stats(user_id)
+    if stats is not None:
+        await _cache_set(key, stats, STATS_CACHE_TTL)
+    return stats
+
+async def _compute_user_stats(user_id: int):
     async with async_session() as session:
         user = await session.scalar(select(User).where(User.id == user_id))
         if not user:
             return None
-        solved_count = await session.scalar(
-            select(func.count(UserSolution.id))
-            .where(UserSolution.user_id == user_id, UserSolution.is_correct == True)
-        ) or 0
-
-        math_solved = await session.scalar(
-            select(func.count(UserSolution.id))
+        # Один проход по user_solutions: количество решённых задач по каждому предмету
+        rows = (await session.execute(
+            select(Problem.subject, func.count(UserSolution.id))
             .join(Problem, Problem.id == UserSolution.problem_id)
-            .where(UserSolution.user_id == user_id,
-                   UserSolution.is_correct == True,
-                   Problem.subject == Subject.MATH)
-        ) or 0
-
-        informatics_solved = await session.scalar(
-            select(func.count(UserSolution.id))
-            .join(Problem, Problem.id == UserSolution.problem_id)
-            .where(UserSolution.user_id == user_id,
-                   UserSolution.is_correct == True,
-                   Problem.subject == Subject.INFORMATICS)
-        ) or 0
+            .where(UserSolution.user_id == user_id, UserSolution.is_correct == True)
+            .group_by(Problem.subject)
+        )).all()
+        counts = {subject: count for subject, count in rows}
+        solved_count = sum(counts.values())
+        math_solved = counts.get(Subject.MATH, 0)
+        informatics_solved = counts.get(Subject.INFORMATICS, 0)
 
         return {
             'score': user.score or 0,